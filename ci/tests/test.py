@@ -1,94 +1,211 @@
 
 import argparse
-import copy
+import errno
+import functools
+import json
 import os
-import requests.adapters
-import ssl
+import shlex
+import shutil
 import subprocess
-import traceback
-import urllib3
+import threading
+import time
 
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, Optional, Tuple
+from typing import (IO, TYPE_CHECKING, Any, Deque, Dict, List, Optional,
+                    Tuple, Union)
 
-urllib3.disable_warnings()
+if TYPE_CHECKING:
+    import requests
+    import ssl
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class CITestsHandler:
 
-    dashboard_url = os.getenv('SDK_DASHBOARD_URL') or os.getenv('TESTING_HOST')
-    record = {
-        'id': os.getenv('SITE_ID'),
-        'key': os.getenv('SDK_DASHBOARD_TOKEN'),  # site_token
-        'data': {
-            'run_id': os.getenv('CI_PIPELINE_ID') or os.getenv('RANDOM'),
-            'branch': os.getenv('CI_COMMIT_BRANCH'),
-            'test_name': '',
-            'test_start_time': '',
-            'test_end_time': '',
-            'module': '',
-            'function': '',
-            'results': {},
-            'extras': {}
+@dataclass(frozen=True)
+class Env:
+
+    """
+    Environment settings, read once at import.
+    """
+
+    dashboard_url: Optional[str]
+    site_id: Optional[str]
+    token: Optional[str]  # site_token
+    run_id: Optional[str]
+    branch: Optional[str]
+    tests_group: str
+    im_number: Optional[str]
+    maintainer: Optional[str]
+
+
+ENV = Env(
+    dashboard_url=os.getenv('SDK_DASHBOARD_URL') or os.getenv('TESTING_HOST'),
+    site_id=os.getenv('SITE_ID'),
+    token=os.getenv('SDK_DASHBOARD_TOKEN'),
+    run_id=os.getenv('CI_PIPELINE_ID') or os.getenv('RANDOM'),
+    branch=os.getenv('CI_COMMIT_BRANCH'),
+    tests_group=os.getenv('TESTS_GROUP', '').lower(),
+    im_number=os.getenv('IM_NUMBER'),
+    maintainer=os.getenv('MAINTAINER'))
+
+
+if orjson is not None:
+    _dumps = orjson.dumps
+else:
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# static part of every record sent to the dashboard (encoded once), the
+# record is {"id": <site_id>, "key": <site_token>, "data": <data>}
+_RECORD_PREFIX = (b'{"id":' + _dumps(ENV.site_id) +
+                  b',"key":' + _dumps(ENV.token) + b',"data":')
+_RECORD_SUFFIX = b'}'
+# shared (read-only) placeholder for absent results and extras
+_EMPTY: Dict = {}
+
+
+def _build_start_data(now_s: str) -> Dict:
+    return {
+        'run_id': ENV.run_id,
+        'branch': ENV.branch,
+        'test_name': 'Set Environment',
+        'test_start_time': now_s,
+        'test_end_time': now_s,
+        'module': '_conftest',
+        'function': '_discover_environment',
+        'results': _EMPTY,
+        'extras': {
+            'start_time': now_s,  # run_start_time
+            'git_branch': ENV.branch,
+            'config': {
+                'im_number': ENV.im_number,
+                'maintainer_email': ENV.maintainer
+            }
         }
     }
 
+
+def _build_end_data(now_s: str) -> Dict:
+    return {
+        'run_id': ENV.run_id,
+        'branch': ENV.branch,
+        'test_name': 'End Test Series',
+        'test_start_time': now_s,
+        'test_end_time': now_s,
+        'module': '_conftest',
+        'function': '_end',
+        'results': _EMPTY,
+        'extras': _EMPTY
+    }
+
+
+def _build_command_data(name: str, start_s: str, end_s: str,
+                        results: Dict) -> Dict:
+    return {
+        'run_id': ENV.run_id,
+        'branch': ENV.branch,
+        'test_name': name,
+        'test_start_time': start_s,
+        'test_end_time': end_s,
+        'module': ENV.tests_group,
+        'function': 'main',
+        'results': results,
+        'extras': {
+            'tests_group': ENV.tests_group
+        }
+    }
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+_SHELL_CHARS = frozenset('|&;<>$`()*?[]{}~=!#\n')
+# builtins of sh, which might also exist as executables with a different
+# behavior (e.g., echo handles escapes differently)
+_SH_BUILTINS = frozenset((
+    '.', ':', 'alias', 'bg', 'break', 'cd', 'command', 'continue', 'echo',
+    'eval', 'exec', 'exit', 'export', 'false', 'fc', 'fg', 'getopts', 'hash',
+    'jobs', 'kill', 'local', 'printf', 'pwd', 'read', 'readonly', 'return',
+    'set', 'shift', 'source', 'test', 'times', 'trap', 'true', 'type',
+    'ulimit', 'umask', 'unalias', 'unset', 'wait'))
+
+_TEST_TIMEOUT = 300  # seconds
+
+_OUTPUT_CHUNK_SIZE = 1 << 16
+# the beginning and the end of the test output are kept (the middle part is
+# dropped only if the output exceeds the sum of these sizes)
+_OUTPUT_HEAD_SIZE = 1 << 20
+_OUTPUT_TAIL_SIZE = 4 << 20
+
+
+@functools.lru_cache(maxsize=None)
+def _ssl_context() -> 'ssl.SSLContext':
+    import ssl
+
+    # certificates are not verified (requests are sent with verify=False),
+    # thus the system CA store is not loaded
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+def _get_session() -> 'requests.Session':
+    """
+    Get the session shared by all handlers (created on first use).
+    :return: Session with the custom transport adapter mounted.
+    :rtype: requests.Session
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            # imported on first use to keep the start of the script fast
+            import requests
+            import urllib3
+
+            # warnings about unverified requests (verify=False)
+            urllib3.disable_warnings()
+            session = requests.session()
+            session.mount('https://', _transport_adapter_class()(
+                _ssl_context(), pool_connections=1, pool_maxsize=4))
+            _SESSION = session
+    return _SESSION
+
+
+class CITestsHandler:
+
+    dashboard_url = ENV.dashboard_url
+
     def __init__(self):
-        ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
-        ctx.check_hostname = False
-        self._session = requests.session()
-        self._session.mount('https://', TransportAdapter(ctx))
+        # results are not sent if the dashboard is not set
+        self._session = _get_session() if self.dashboard_url else None
 
     def run(self, start: Optional[bool] = False, end: Optional[bool] = False,
             command: Optional[str] = None, **kwargs: Any) -> None:
         assert ismuex(start, end, command), 'Arguments are mutually exclusive'
 
-        record = copy.deepcopy(self.record)
-
         if start:
-            record['data'].update({
-                'test_name': 'Set Environment',
-                'test_start_time': str(datetime.now()),
-                'test_end_time': str(datetime.now()),
-                'module': '_conftest',
-                'function': '_discover_environment',
-                'extras': {
-                    'start_time': str(datetime.now()),  # run_start_time
-                    'git_branch': record['data']['branch'],
-                    'config': {
-                        'im_number': os.getenv('IM_NUMBER'),
-                        'maintainer_email': os.getenv('MAINTAINER')
-                    }
-                }
-            })
+            data = _build_start_data(str(datetime.now()))
 
         elif end:
-            record['data'].update({
-                'test_name': 'End Test Series',
-                'test_start_time': str(datetime.now()),
-                'test_end_time': str(datetime.now()),
-                'module': '_conftest',
-                'function': '_end'
-            })
+            data = _build_end_data(str(datetime.now()))
 
         elif command:
-            tests_group = os.getenv('TESTS_GROUP', '').lower()
             name = kwargs.get('name') or command.split()[0]
 
-            start_time = str(datetime.now())
-            results, out = self.execute_test(command)
-            record['data'].update({
-                'test_name': name,
-                'test_start_time': start_time,
-                'test_end_time': str(datetime.now()),
-                'module': tests_group,
-                'function': 'main',
-                'results': results,
-                'extras': {
-                    'tests_group': tests_group
-                }
-            })
+            start_s = str(datetime.now())
+            results, out = self.execute_test(
+                command, keep_output=bool(kwargs.get('stdout')))
+            end_s = str(datetime.now())
+            data = _build_command_data(name, start_s, end_s, results)
 
             if kwargs.get('stdout'):
                 print(out)
@@ -98,10 +215,18 @@ class CITestsHandler:
         else:
             raise RuntimeError('No viable option called, exiting...')
 
-        self._session.post(self.dashboard_url, json=record, verify=False)
+        if self._session is None:
+            return
+
+        body = _RECORD_PREFIX + _dumps(data) + _RECORD_SUFFIX
+        response = self._session.post(self.dashboard_url, data=body,
+                                      headers=_JSON_HEADERS, verify=False)
+        # the body is not read, the connection is returned to the pool
+        response.close()
 
     @staticmethod
-    def execute_test(command: str) -> Tuple[Dict, str]:
+    def execute_test(command: str,
+                     keep_output: bool = True) -> Tuple[Dict, str]:
         results = {'setup': {'passed': True,
                              'status': 'passed',
                              'exception': None,
@@ -111,20 +236,59 @@ class CITestsHandler:
                              'exception': None,
                              'report': ''}}
 
+        output = _OutputBuffer()
         try:
-            out = subprocess.check_output(command, shell=True,
-                                          stderr=subprocess.STDOUT,
-                                          timeout=300)
+            args, executable = _command_args(command)
+            try:
+                proc = _popen(args, executable)
+            except OSError as e:
+                if executable is None or e.errno != errno.ENOEXEC:
+                    raise
+                # executable file is neither a binary nor a script with
+                # "#!", thus it is run by the shell (as execvp does)
+                proc = _popen(command)
+            reader = threading.Thread(target=_read_output,
+                                      args=(proc.stdout, output),
+                                      daemon=True)
+            reader.start()
+            deadline = time.monotonic() + _TEST_TIMEOUT
+            try:
+                try:
+                    retcode = proc.wait(timeout=_TEST_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    retcode = None
+                else:
+                    # the pipe might be held open by background children of
+                    # the process, thus reading the output shares the limit
+                    reader.join(timeout=max(deadline - time.monotonic(), 0))
+                if retcode is None or reader.is_alive():
+                    raise subprocess.TimeoutExpired(command, _TEST_TIMEOUT)
+            except BaseException:
+                # the reader is not joined (it is a daemon thread), since
+                # the pipe might be held open by orphaned children
+                proc.kill()
+                proc.wait()
+                raise
+            if retcode:
+                raise subprocess.CalledProcessError(retcode, command)
         except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
-            out = e.output.decode('utf-8') if e.output else ''
+            out = output.decode()
+            status = 'failed'
+            exception = str(repr(e))
+        except OSError as e:
+            # command is executed directly and could not be started
+            out = str(e)
             status = 'failed'
             exception = str(repr(e))
         except KeyboardInterrupt as e:
+            import traceback
             out = traceback.format_exc()
             status = 'failed'
             exception = str(repr(e))
         else:
-            out = out.decode('utf-8') if out else ''
+            # the report of a passed test is empty, thus the output is
+            # decoded only if it was requested
+            out = output.decode() if keep_output else ''
             status = 'passed'
             exception = None
 
@@ -137,9 +301,113 @@ class CITestsHandler:
         return results, out
 
 
+def _command_args(command: str) -> Tuple[Union[str, List[str]],
+                                          Optional[str]]:
+    """
+    Get arguments to execute the command: commands without shell syntax
+    (pipes, redirections, expansions, etc.) that start with an executable
+    are executed directly, others (e.g., with shell builtins) by the shell.
+    :return: Arguments and the full path of the executable (None if the
+             command is executed by the shell).
+    :rtype: tuple
+    """
+    if not any(c in _SHELL_CHARS for c in command):
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            args = []
+        executable = None
+        if args and args[0] not in _SH_BUILTINS:
+            executable = shutil.which(args[0])
+        if executable:
+            return args, executable
+    return command, None
+
+
+def _popen(args: Union[str, List[str]],
+           executable: Optional[str] = None) -> subprocess.Popen:
+    """
+    Start the command by the shell, or directly if the executable is set.
+    :return: Started process.
+    :rtype: subprocess.Popen
+    """
+    kwargs = {'stdout': subprocess.PIPE,
+              'stderr': subprocess.STDOUT,
+              'bufsize': _OUTPUT_CHUNK_SIZE}
+    if executable is None:
+        return subprocess.Popen(args, shell=True, **kwargs)
+    # with the full path of the executable and no descriptors to close in
+    # the child, posix_spawn is used; the trade-off is that descriptors
+    # inherited from the CI runner are passed to the test (and to daemons
+    # started by it), not only the non-inheritable ones opened by Python
+    return subprocess.Popen(args, executable=executable, close_fds=False,
+                            **kwargs)
+
+
+class _OutputBuffer:
+
+    """
+    Output of a test run limited in size: if the output is too long, its
+    middle part is dropped and replaced by a truncation marker.
+    """
+
+    def __init__(self, head_size: int = _OUTPUT_HEAD_SIZE,
+                 tail_size: int = _OUTPUT_TAIL_SIZE):
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._head = bytearray()
+        self._tail: Deque[bytes] = deque()
+        self._tail_len = 0
+        self._truncated = 0
+        # output might be decoded while the reader is still running
+        self._lock = threading.Lock()
+
+    def append(self, chunk: bytes) -> None:
+        with self._lock:
+            free = self._head_size - len(self._head)
+            if free > 0:
+                self._head += chunk[:free]
+                chunk = chunk[free:]
+                if not chunk:
+                    return
+            self._tail.append(chunk)
+            self._tail_len += len(chunk)
+            # drop the oldest bytes of the tail beyond its size
+            while self._tail_len > self._tail_size:
+                excess = self._tail_len - self._tail_size
+                first = self._tail[0]
+                if len(first) > excess:
+                    self._tail[0] = first[excess:]
+                    dropped = excess
+                else:
+                    self._tail.popleft()
+                    dropped = len(first)
+                self._tail_len -= dropped
+                self._truncated += dropped
+
+    def decode(self) -> str:
+        with self._lock:
+            head = bytes(self._head)
+            tail = b''.join(self._tail)
+            truncated = self._truncated
+        if not truncated:
+            return (head + tail).decode('utf-8', 'replace')
+        return '%s\n[... %d bytes truncated]\n%s' % (
+            head.decode('utf-8', 'replace'), truncated,
+            tail.decode('utf-8', 'replace'))
+
+
+def _read_output(pipe: IO[bytes], output: _OutputBuffer) -> None:
+    with pipe:
+        for chunk in iter(lambda: pipe.read1(_OUTPUT_CHUNK_SIZE), b''):
+            output.append(chunk)
+
+
 def ismuex(*a):
-    return not bool(sum(map(
-        lambda v: bool(v if isinstance(v, bool) else v is not None), a)) > 1)
+    n = 0
+    for v in a:
+        n += v if isinstance(v, bool) else v is not None
+    return n <= 1
 
 
 def get_args():
@@ -172,25 +440,34 @@ def get_args():
     return parser.parse_args()
 
 
-class TransportAdapter(requests.adapters.HTTPAdapter):
+@functools.lru_cache(maxsize=None)
+def _transport_adapter_class() -> type:
+    # the class is created on first use, since requests is imported lazily
+    import requests.adapters
+    import urllib3
 
-    """
-    Transport adapter that allows to use custom ssl_context.
-    """
+    class TransportAdapter(requests.adapters.HTTPAdapter):
+
+        """
+        Transport adapter that allows to use custom ssl_context.
+        """
+
+        def __init__(self, ssl_context=None, **kwargs):
+            self.ssl_context = ssl_context
+            super().__init__(**kwargs)
 
-    def __init__(self, ssl_context=None, **kwargs):
-        self.ssl_context = ssl_context
-        super().__init__(**kwargs)
+        def init_poolmanager(self, connections, maxsize, block=False,
+                             **kwargs):
+            # save these values for pickling
+            self._pool_connections = connections
+            self._pool_maxsize = maxsize
+            self._pool_block = block
 
-    def init_poolmanager(self, connections, maxsize, block=False, **kwargs):
-        # save these values for pickling
-        self._pool_connections = connections
-        self._pool_maxsize = maxsize
-        self._pool_block = block
+            self.poolmanager = urllib3.poolmanager.PoolManager(
+                num_pools=connections, maxsize=maxsize, block=block,
+                ssl_context=self.ssl_context, **kwargs)
 
-        self.poolmanager = urllib3.poolmanager.PoolManager(
-            num_pools=connections, maxsize=maxsize, block=block,
-            ssl_context=self.ssl_context, **kwargs)
+    return TransportAdapter
 
 
 if __name__ == '__main__':